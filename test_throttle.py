@@ -1,9 +1,15 @@
 import unittest
+from math import ceil, inf
 from time import time
 
 # TODO: Fix this to remove the dependancy on the `redis` library
 from redis.lock import Lock, LockError
 
+try:
+    from lupa.lua51 import LuaRuntime
+except ImportError:
+    LuaRuntime = None
+
 from .simplecache import Cache
 from .throttle import throttle, ThrottleTimeout
 
@@ -28,9 +34,19 @@ class MockLockableCache(Cache):
 
     def get(self, key, default=None):
         if self.limited:
-            return time()
+            # Next call due one 10 calls/second interval from now, always
+            return time() + 0.1
         return self._cache.get(self.make_key(key), default)
 
+    def get_many(self, keys):
+        found = ((key, self.get(key)) for key in keys)
+        return dict((key, value) for key, value in found if value is not None)
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+        return []
+
     def lock(self, key, version=None, timeout=None, sleep=0.1,
              blocking_timeout=None):
         name = self.make_key(key, version=version)
@@ -43,13 +59,119 @@ class MockLockableCache(Cache):
         self._cache = {}
 
 
+class MockAtomicCache(MockLockableCache):
+    atomic = True
+
+
+class MockReservationCache(Cache):
+    """
+    A cache without the lock interface but with an `add` honouring
+    sub-second timeouts.
+    """
+    precise_timeouts = True
+
+    def get(self, key, default=None):
+        value, expires = self._cache.get(self.make_key(key), (default, inf))
+        return value if expires > time() else default
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        self._cache[self.make_key(key)] = (value, time() + timeout)
+        return True
+
+    def reset(self):
+        self._cache = {}
+
+
+class MockLaggingCache(MockReservationCache):
+    """
+    A reservation cache whose keys expire later than asked (here by
+    rounding timeouts up), so claims outlive the time stored in them.
+    """
+    adds = 0
+
+    def add(self, key, value, timeout=None):
+        self.adds += 1
+        return super().add(key, value, ceil(timeout))
+
+    def reset(self):
+        self.adds = 0
+        super().reset()
+
+
+class MockTruncatingCache(MockReservationCache):
+    """
+    A reservation cache truncating timeouts to whole seconds and expiring
+    keys at once for a timeout of 0, as django's memcached and redis
+    backends do.
+    """
+    precise_timeouts = False
+
+    def add(self, key, value, timeout=None):
+        timeout = int(timeout)
+        if not timeout:
+            return self.get(key) is None
+        return super().add(key, value, timeout)
+
+
+class MockScriptingCache(object):
+    """
+    A cache exposing a redis-style `register_script` hook, running scripts
+    in a Lua 5.1 runtime (as redis does) against just enough of `redis.call`.
+    """
+
+    def __init__(self):
+        self.lua = LuaRuntime()
+        self.redis = self.lua.table(call=self.call)
+        self.reset()
+
+    def get(self, key):
+        value, expires = self._cache.get(key, (None, inf))
+        return value if expires > time() else None
+
+    def call(self, command, *args):
+        if command == 'GET':
+            return self.get(args[0]) or False
+        if command == 'MGET':
+            return self.lua.table(*[self.get(key) or False for key in args])
+        if command == 'SET':
+            key, value, unit, expire = args
+            assert unit == 'PX'
+            self._cache[key] = (value, time() + expire / 1000.0)
+            return True
+        raise ValueError('Unsupported command %s' % command)
+
+    def register_script(self, source):
+        run = self.lua.eval('function(redis, KEYS, ARGV) %s end' % source)
+
+        def script(keys=(), args=()):
+            # Redis passes every argument as a string and truncates a
+            # returned number to an integer
+            args = [str(arg) for arg in args]
+            return int(run(
+                self.redis, self.lua.table(*keys), self.lua.table(*args)))
+
+        return script
+
+    def reset(self):
+        self.limited = self.blocked = False
+        self._cache = {}
+
+
 mock_cache = MockLockableCache()
+atomic_cache = MockAtomicCache()
+reservation_cache = MockReservationCache()
+script_cache = MockScriptingCache() if LuaRuntime else None
+lagging_cache = MockLaggingCache()
+truncating_cache = MockTruncatingCache()
 
 
-def measure_drift(func, count=1, blocked=False, limited=False):
-    mock_cache.reset()
-    mock_cache.blocked = blocked
-    mock_cache.limited = limited
+def measure_drift(func, count=1, blocked=False, limited=False,
+                  cache=mock_cache):
+    cache.reset()
+    cache.blocked = blocked
+    cache.limited = limited
     expected = func() * count
     start = time()
     while count:
@@ -118,3 +240,190 @@ class TestThrottle(unittest.TestCase):
 
         with self.assertRaises(ThrottleTimeout):
             measure_drift(func, limited=True)
+
+    def test_throttle_local_fastpath(self):
+        """
+        A call the current thread already knows to be rate-limited should
+        be dropped without touching the cache.
+        """
+
+        @throttle(10, key=lambda *args: 'local', cache=mock_cache,
+                  retry=False, marker='limited')
+        def func():
+            return 0.1
+
+        mock_cache.reset()
+        self.assertEqual(func(), 0.1)
+        mock_cache.blocked = True
+        self.assertEqual(func(), 'limited')
+
+    def test_throttle_atomic(self):
+        """
+        A cache flagged as atomic should be used without taking a lock.
+        """
+
+        @throttle(10, key=lambda *args: 'atomic', cache=atomic_cache)
+        def func():
+            return 0.1
+
+        atomic_cache.reset()
+        atomic_cache.blocked = True
+        self.assertEqual(func(), 0.1)
+
+    def test_throttle_multi_single(self):
+        """
+        A single rate limit passed in a list should behave just like the
+        same rate limit passed on its own.
+        """
+
+        @throttle([10], cache=mock_cache)
+        def func():
+            return 0.1
+
+        expected, real = measure_drift(func, count=3)
+        self.assertNotDrifted(expected, real)
+
+    def test_throttle_reservation(self):
+        """
+        A cache without a lock interface should still throttle calls by
+        claiming each bucket with `add`.
+        """
+
+        @throttle(10, key=lambda *args: 'reserved', cache=reservation_cache,
+                  local_fastpath=False)
+        def func():
+            return 0.1
+
+        @throttle([10, 5], key=[lambda *args: 'reserved',
+                                lambda *args: 'reserved-slow'],
+                  cache=reservation_cache, local_fastpath=False)
+        def func_multi():
+            return 0.2
+
+        reservation_cache.reset()
+        start = time()
+        for count in range(3):
+            func()
+        self.assertNotDrifted(0.2, time() - start)
+
+        reservation_cache.reset()
+        start = time()
+        for count in range(3):
+            func_multi()
+        self.assertNotDrifted(0.4, time() - start)
+
+    def test_throttle_reservation_lagging(self):
+        """
+        A claim outliving its due time should be retried at a measured pace
+        and still time out.
+        """
+
+        @throttle(10, key=lambda *args: 'lagging', cache=lagging_cache,
+                  timeout=.3, local_fastpath=False)
+        def func():
+            return 0.1
+
+        lagging_cache.reset()
+        func()
+        start = time()
+        with self.assertRaises(ThrottleTimeout):
+            func()
+        self.assertLess(time() - start, 0.4)
+        self.assertLess(lagging_cache.adds, 100)
+
+    def test_throttle_reservation_truncated(self):
+        """
+        A cache whose `add` may cut sub-second timeouts short would let
+        every call through, so it should be refused at decoration.
+        """
+
+        with self.assertRaises(TypeError):
+            throttle(10, cache=truncating_cache)
+        with self.assertRaises(TypeError):
+            throttle([10, 5], key=[lambda *args: 'truncated',
+                                   lambda *args: 'truncated-slow'],
+                     cache=truncating_cache)
+
+    def test_throttle_burst(self):
+        """
+        A throttle allowing bursts should let that many calls through
+        back to back before falling back to the limit rate.
+        """
+
+        @throttle(10, cache=mock_cache, burst=3)
+        def func():
+            return 0.1
+
+        mock_cache.reset()
+        start = time()
+        for count in range(5):
+            func()
+        self.assertNotDrifted(0.2, time() - start)
+
+    @unittest.skipIf(LuaRuntime is None, 'lupa is needed to run Lua scripts')
+    def test_throttle_script(self):
+        """
+        A cache with a scripting hook should be throttled by the script
+        alone.
+        """
+
+        @throttle(10, key=lambda *args: 'script', cache=script_cache,
+                  local_fastpath=False)
+        def func():
+            return 0.1
+
+        expected, real = measure_drift(func, count=3, cache=script_cache)
+        self.assertNotDrifted(expected, real)
+
+    @unittest.skipIf(LuaRuntime is None, 'lupa is needed to run Lua scripts')
+    def test_throttle_script_multi(self):
+        """
+        Multiple rate limits on distinct keys should be throttled to the
+        slowest rate by the script.
+        """
+
+        @throttle([10, 5], key=[lambda *args: 'script',
+                                lambda *args: 'script-slow'],
+                  cache=script_cache, local_fastpath=False)
+        def func():
+            return 0.2
+
+        expected, real = measure_drift(func, count=3, cache=script_cache)
+        self.assertNotDrifted(expected, real)
+
+    @unittest.skipIf(LuaRuntime is None, 'lupa is needed to run Lua scripts')
+    def test_throttle_script_dropped(self):
+        """
+        A rate-limited call shouldn't be retried when `retry` is False, and
+        shouldn't reserve a slot either.
+        """
+
+        @throttle(10, key=lambda *args: 'script', cache=script_cache,
+                  retry=False, marker='limited', local_fastpath=False)
+        def func():
+            return 0.1
+
+        script_cache.reset()
+        self.assertEqual(func(), 0.1)
+        due = script_cache.get('script')
+        self.assertEqual(func(), 'limited')
+        self.assertEqual(script_cache.get('script'), due)
+
+    @unittest.skipIf(LuaRuntime is None, 'lupa is needed to run Lua scripts')
+    def test_throttle_script_timeout(self):
+        """
+        A call whose next slot is further away than the timeout should
+        throw an error straight away rather than wait.
+        """
+
+        @throttle(1, key=lambda *args: 'script', cache=script_cache,
+                  timeout=.5, local_fastpath=False)
+        def func():
+            return 1
+
+        script_cache.reset()
+        func()
+        start = time()
+        with self.assertRaises(ThrottleTimeout):
+            func()
+        self.assertLess(time() - start, 0.1)
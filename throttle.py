@@ -1,11 +1,17 @@
+import inspect
 import logging
-from itertools import izip_longest
-from time import time, sleep
+import threading
+from contextlib import ExitStack, nullcontext
+from functools import partial, wraps
+from itertools import zip_longest
+from math import inf
+from time import monotonic, sleep, time
 
-from decorator import decorator
-
-# Warning: The simplecache doesn't support the expected lock interface
-# so make sure to use a lockable cache.
+# Warning: The simplecache doesn't support the expected lock interface.
+# Caches without it fall back to claiming buckets with `cache.add`, which
+# is only safe if `add` is atomic and honours sub-second timeouts. Better
+# yet, use a cache exposing a redis-style `register_script` hook so the
+# rate-limit check can be evaluated atomically server-side.
 # See https://pypi.org/project/redis for an example.
 from .cache import CACHE, cachekey_static
 
@@ -22,13 +28,13 @@ except ImportError:
 if THROTTLE_LOGGING:
     logger = logging.getLogger(LOGGER_PREFIX + __name__)
 
-    def log_message(label, text, seconds):
-        if isinstance(label, (tuple, list)):
-            label = str([i[1] for i in label])
-        return '"%s" throttle %s %s seconds' % (label, text, seconds)
-
     def log_info(label, text, seconds):
-        logger.info(log_message(label, text, seconds))
+        # Leave the formatting to the logger, and skip it entirely when
+        # info messages aren't wanted at all.
+        if logger.isEnabledFor(logging.INFO):
+            if isinstance(label, (tuple, list)):
+                label = list(label)
+            logger.info('"%s" throttle %s %s seconds', label, text, seconds)
         
     def log_warning(*args, **kwargs):
         logger.warning(*args, **kwargs)
@@ -43,8 +49,132 @@ class ThrottleTimeout(Exception):
     pass
 
 
+# When each bucket is next due as far as the current thread knows. This is
+# a lower bound on the bucket's shared state so it's safe to wait it out
+# locally before asking the cache. Being process-local, these use the
+# monotonic clock; anything written to the cache uses wall-clock time
+# so it stays comparable across processes.
+_local = threading.local()
+_LOCAL_MAX_KEYS = 1000
+
+# The longest pause before retrying an `add` claim that's still held even
+# though its value says it's due, as happens when the key's expiry lags
+# behind the clock of the process that claimed it.
+_CLAIM_RETRY = 0.01
+
+
+def _local_calls():
+    try:
+        calls = _local.calls
+    except AttributeError:
+        calls = _local.calls = {}
+    if len(calls) > _LOCAL_MAX_KEYS:
+        calls.clear()
+    return calls
+
+
+def _bind_args(func):
+    """
+    Return a function binding call arguments to the signature of `func`
+    with defaults applied, which is how key functions expect to see them.
+    """
+    signature = inspect.signature(func)
+    # Positional calls to a function taking only plain positional
+    # parameters without defaults bind to exactly what was passed, so
+    # the (comparatively slow) signature binding can be skipped.
+    arity = len(signature.parameters)
+    simple = all(
+        p.kind == p.POSITIONAL_OR_KEYWORD and p.default is p.empty
+        for p in signature.parameters.values())
+
+    def bind(args, kwargs):
+        if simple and not kwargs and len(args) == arity:
+            return args, kwargs
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return bound.args, bound.kwargs
+
+    return bind
+
+
+def _nolock(name):
+    return nullcontext()
+
+
+def _lock_name(key):
+    # One lock per bucket so unrelated buckets don't contend on each other
+    return 'throttle.lock:%s' % key
+
+
+# Atomic check-and-set of a single rate-limit bucket.
+# KEYS: bucket; ARGV: now, wait, burst, minimum, expire (ms)
+# The bucket holds the time its next call is due, and a call is let
+# through once it's no more than `burst - 1` intervals ahead of that (the
+# generic cell rate algorithm), so bursts are absorbed without retries.
+# If the bucket is limited but frees up within `wait` seconds, the next
+# free slot is reserved for the caller so it can just sleep until then
+# without having to ask again. Otherwise nothing is reserved and the delay
+# is returned negated. Lua numbers are truncated to integers on the way
+# back to the client so the delay is returned in (rounded up) microseconds.
+_LUA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local minimum = tonumber(ARGV[4])
+local tolerance = (tonumber(ARGV[3]) - 1) * minimum
+local due = tonumber(redis.call('GET', KEYS[1])) or 0
+local delay = math.max(due - tolerance - now, 0)
+if delay > tonumber(ARGV[2]) then
+    return -math.ceil(delay * 1e6)
+end
+local nextdue = math.max(due, now + delay) + minimum
+redis.call('SET', KEYS[1], string.format('%.6f', nextdue),
+           'PX', tonumber(ARGV[5]) + math.ceil((nextdue - now) * 1000))
+return math.ceil(delay * 1e6)
+"""
+
+# Same as above but for several buckets. Either every bucket is reserved
+# or none are, at the time when all of them are free.
+# KEYS: buckets; ARGV: now, wait, burst, minimums..., expires (ms)...
+_LUA_MULTI_SCRIPT = """
+local now = tonumber(ARGV[1])
+local burst = tonumber(ARGV[3])
+local n = #KEYS
+local dues = redis.call('MGET', unpack(KEYS))
+local delay = 0
+for i = 1, n do
+    dues[i] = tonumber(dues[i]) or 0
+    local wait = dues[i] - (burst - 1) * tonumber(ARGV[i + 3]) - now
+    if wait > delay then
+        delay = wait
+    end
+end
+if delay > tonumber(ARGV[2]) then
+    return -math.ceil(delay * 1e6)
+end
+for i, key in ipairs(KEYS) do
+    local nextdue = math.max(dues[i], now + delay) + tonumber(ARGV[i + 3])
+    local lead = math.ceil((nextdue - now) * 1000)
+    redis.call('SET', key, string.format('%.6f', nextdue),
+               'PX', tonumber(ARGV[n + i + 3]) + lead)
+end
+return math.ceil(delay * 1e6)
+"""
+
+
+def _register_script(cache, script):
+    """
+    Return `script` registered with the redis client behind `cache`, or None
+    if neither the cache nor its `client` expose a `register_script` hook.
+    """
+    for client in (cache, getattr(cache, 'client', None)):
+        register = getattr(client, 'register_script', None)
+        if register is not None:
+            return register(script)
+    return None
+
+
 def throttle(limit, key=cachekey_static, cache=CACHE,
-             retry=True, timeout=None, marker=None, lockargs=None):
+             retry=True, timeout=None, marker=None, lockargs=None,
+             local_fastpath=True, burst=1):
     """
     A decorator to ensure function calls are rate-limited. Calls exceeding
     limit are dropped or retried until limit condition is satisfied.
@@ -62,23 +192,42 @@ def throttle(limit, key=cachekey_static, cache=CACHE,
         (default: static_cachekey)
     `cache`
         Cache object with django cache style  `set` and `get` interface
-        (default: django_cache )
+        (plus `set_many` and `get_many` for multiple limits),
+        or with a redis-style `register_script` hook (default: django_cache).
+        Caches flagged with `atomic = True` are trusted not to interleave
+        calls and are used without `cache.lock`. Caches with neither a
+        `lock` nor a scripting hook must provide an atomic `add` honouring
+        sub-second timeouts, and say so with `precise_timeouts = True`
+        (django's memcached and redis backends truncate them).
     `retry`
         If True, retry until rate-limit condition is satisfied or until timeout
         (default: True)
     `timeout`
-        Maximum time limit before next retry attempt should just raise an error
-        (default: the greater of 10 seconds or 10/limit)
+        Maximum time a call may wait for its turn. A call raises
+        ThrottleTimeout straight away when its next free slot is further
+        away than that (default: the greater of 10 seconds or 10/limit)
     `marker`
         Object returned when call is rate-limited and `retry` is False
         (default: None)
     `lockargs`
         A dictionary to override the default kwargs for `cache.lock` function.
         (default: None)
+    `local_fastpath`
+        If True, calls the current thread already knows to be rate-limited
+        are delayed or dropped without first asking the cache. Only used
+        when `burst` is 1 (default: True)
+    `burst`
+        Number of calls let through back to back before the rate applies,
+        as long as the average rate stays within `limit` (default: 1)
     """
     if not THROTTLE_ENABLED:
         return lambda func: func
 
+    assert burst >= 1
+    # Earlier calls may only be known to bound the wait when nothing can
+    # be let through early.
+    local_fastpath = local_fastpath and burst == 1
+
     _timeout = timeout or 10
     multi = isinstance(limit, (tuple, list))
     if multi:
@@ -87,88 +236,302 @@ def throttle(limit, key=cachekey_static, cache=CACHE,
         assert len(limit) >= len(key)
         minimum = [1.0 / float(l) for l in limit]
         maximum = max(minimum)
-        expire = [max(10 * m, _timeout) for m in minimum]
-        limit = list(izip_longest(
-            minimum, key, expire, fillvalue=cachekey_static))
+        expire = [max(10 * m, _timeout) + (burst - 1) * m for m in minimum]
+        # Unlimited rates (`float('inf')`) can never delay a call
+        limit = tuple(
+            l for l in zip_longest(
+                minimum, key, expire, fillvalue=cachekey_static) if l[0])
+        if not limit:
+            return lambda func: func
+        if len(limit) == 1:
+            # Nothing to combine, so skip the multi-limit machinery
+            multi = False
+            (minimum, key, expire), = limit
     else:
         minimum = maximum = 1.0 / float(limit)
-        expire = max(10 * minimum, _timeout)
+        expire = max(10 * minimum, _timeout) + (burst - 1) * minimum
+        if not minimum:
+            return lambda func: func
+
+    if multi:
+        minimums, key_fns, expires = zip(*limit)
+        tolerances = tuple((burst - 1) * m for m in minimums)
+        windows = tuple(burst * m for m in minimums)
+        expires_ms = tuple(int(e * 1000) for e in expires)
+        # Script arguments for the usual case where no bucket is dropped
+        args_tail = list(minimums + expires_ms)
+        # Buckets are stored together so they share the longest expiry
+        expire_many = max(expires)
+    else:
+        tolerance = (burst - 1) * minimum
+        window = burst * minimum
+        args_tail = [minimum, int(expire * 1000)]
 
     timeout = timeout or max(10, maximum * 10)
     lockargs = lockargs or dict(timeout=1, blocking_timeout=timeout)
+    script = _register_script(
+        cache, _LUA_MULTI_SCRIPT if multi else _LUA_SCRIPT)
+    cache_add = None
+    if not script:
+        # Bind the cache methods once rather than on every call
+        cache_get, cache_set = cache.get, cache.set
+        if getattr(cache, 'atomic', False):
+            cache_lock = _nolock
+        else:
+            cache_lock = getattr(cache, 'lock', None)
+        if cache_lock is None:
+            # Without a lock, each bucket is split into `burst` slots which
+            # are claimed with `add` for `burst` intervals and freed again
+            # by the keys' own expiry. Backends that cut those timeouts
+            # short would let every call through, so they're refused.
+            if not getattr(cache, 'precise_timeouts', False):
+                raise TypeError(
+                    'Throttle cache needs a `lock`, a `register_script` '
+                    'hook or an `add` flagged with `precise_timeouts`')
+            cache_add, cache_delete = cache.add, cache.delete
+        else:
+            if cache_lock is not _nolock:
+                cache_lock = partial(cache_lock, **lockargs)
+            if multi:
+                cache_get_many = cache.get_many
+                cache_set_many = cache.set_many
 
     def _message(label, text, seconds):
         if multi:
-            label = str([i[1] for i in label])
+            label = str(list(label))
         return '"%s" throttle %s %s seconds' % (label, text, seconds)
 
-    def _now(label, start):
-        now = time()
-        if now - start > timeout:
-            message = log_message(label, 'timeout after', now - start)
-            log_warning(message)
-            raise ThrottleTimeout(message)
-        return now
-
-    @decorator
-    def single_limit(func, *args, **kwargs):
-        _key = key(func, args, kwargs)
-
-        if _key:
-            start = time()
-            done = False
-
-            while not done:
-                delay = 0
-                done = True
-                with cache.lock('throttle.lock', **lockargs):
-                    now = _now(_key, start)
-                    delay = max(cache.get(_key, 0) + minimum - now, 0)
-                    if not delay:
-                        cache.set(_key, now, expire)
-                if delay:
-                    if not retry:
-                        return marker
-                    log_info(_key, 'retry in', delay)
-                    sleep(delay)
-                    done = False
-
-        return func(*args, **kwargs)
-
-    @decorator
-    def multi_limit(func, *args, **kwargs):
-        _limits = [
-            (minimum, key(func, args, kwargs), expire)
-            for minimum, key, expire in limit]
-        _limits = [
-            (minimum, key, expire)
-            for minimum, key, expire in _limits if key]
-
-        if _limits:
-            start = time()
-            done = False
-
-            while not done:
-                delay = 0
-                done = True
-                with cache.lock('throttle.lock', **lockargs):
-                    now = _now(_limits, start)
-                    seen = set()
-                    for minimum, key, expire in _limits:
-                        if key in seen:
-                            continue
-                        seen.add(key)
-                        delay = max(cache.get(key, 0) + minimum - now, 0)
-                        if delay:
+    def _timeout_error(label, text, seconds):
+        message = _message(label, text, seconds)
+        log_warning(message)
+        return ThrottleTimeout(message)
+
+    def _wait(label, delay, remaining):
+        # Rather than sleeping only to time out afterwards, give up as soon
+        # as it's clear the call can't go ahead in the time remaining.
+        if not retry:
+            return False
+        if delay > remaining:
+            raise _timeout_error(label, 'timeout, next slot in', delay)
+        log_info(label, 'delayed', delay)
+        sleep(delay)
+        return True
+
+    def _remaining(label, deadline):
+        # Checked on every pass, since a retry doesn't always sleep first
+        remaining = deadline - monotonic()
+        if remaining < 0:
+            raise _timeout_error(label, 'timeout after', timeout)
+        return remaining
+
+    # The longest delay a scripted check may reserve a slot for
+    wait = timeout if retry else 0
+
+    def _reserve(label, keys, args):
+        # Return the delay waited out for the reserved slot, or None if the
+        # call is dropped. The script returns the delay negated when it's
+        # longer than `wait` and nothing was reserved.
+        delay = script(keys=keys, args=[time(), wait, burst, *args]) / 1e6
+        if delay < 0:
+            if not retry:
+                return None
+            raise _timeout_error(label, 'timeout, next slot in', -delay)
+        if delay:
+            log_info(label, 'delayed', delay)
+            sleep(delay)
+        return delay
+
+    def _slots(key):
+        if burst == 1:
+            return (key,)
+        return tuple('%s:%s' % (key, i) for i in range(burst))
+
+    def _claim(slots, now, window):
+        for slot in slots:
+            if cache_add(slot, now + window, window):
+                return slot
+        return None
+
+    def _claim_delay(slots, now, window):
+        # Always pause a little, or a claim outliving its due time would
+        # be retried back to back until it finally expires.
+        delay = min(cache_get(slot, now) for slot in slots) - now
+        return max(delay, min(window, _CLAIM_RETRY))
+
+    def single_limit(func):
+        bind = _bind_args(func)
+        # The static key doesn't depend on the call arguments
+        static_key = key(func, (), {}) if key is cachekey_static else None
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            _key = static_key or key(func, *bind(args, kwargs))
+
+            if _key and local_fastpath:
+                calls = _local_calls()
+                delay = calls.get(_key, -inf) - monotonic()
+                if delay > 0 and not _wait(_key, delay, timeout):
+                    return marker
+
+            if _key and script:
+                started = monotonic()
+                delay = _reserve(_key, (_key,), args_tail)
+                if delay is None:
+                    return marker
+                started += delay
+
+            elif _key and cache_add:
+                slots = _slots(_key)
+                deadline = monotonic() + timeout
+                done = False
+
+                while not done:
+                    started, now = monotonic(), time()
+                    done = _claim(slots, now, window)
+                    if not done:
+                        delay = _claim_delay(slots, now, window)
+                        remaining = _remaining(_key, deadline)
+                        if not _wait(_key, delay, remaining):
+                            return marker
+
+            elif _key:
+                lock_name = _lock_name(_key)
+                deadline = monotonic() + timeout
+                done = False
+
+                while not done:
+                    started = monotonic()
+                    with cache_lock(lock_name):
+                        now = time()
+                        due = cache_get(_key, 0)
+                        delay = due - tolerance - now
+                        done = delay <= 0
+                        if done:
+                            cache_set(_key, max(due, now) + minimum, expire)
+                    if not done:
+                        remaining = _remaining(_key, deadline)
+                        if not _wait(_key, delay, remaining):
+                            return marker
+
+            if _key and local_fastpath:
+                # Counted from before the cache round trip, so its latency
+                # isn't waited out again on the next call
+                calls[_key] = started + minimum
+
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    def multi_limit(func):
+        bind = _bind_args(func)
+        # Call each distinct key function only once per call, and the
+        # static key (which doesn't depend on the call arguments) only
+        # once per decorated function.
+        static_keys = {}
+        if cachekey_static in key_fns:
+            static_keys[cachekey_static] = cachekey_static(func, (), {})
+        key_fns_called = tuple(
+            key_fn for key_fn in dict.fromkeys(key_fns)
+            if key_fn not in static_keys)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            resolved = static_keys
+            if key_fns_called:
+                resolved = static_keys.copy()
+                _args, _kwargs = bind(args, kwargs)
+                for key_fn in key_fns_called:
+                    resolved[key_fn] = key_fn(func, _args, _kwargs)
+
+            # Map each bucket key to the first tier using it, dropping empty
+            # and repeated keys so each bucket is only tested once.
+            buckets = {}
+            for tier, key_fn in enumerate(key_fns):
+                key = resolved[key_fn]
+                if key and key not in buckets:
+                    buckets[key] = tier
+            keys = tuple(buckets)
+
+            if keys and local_fastpath:
+                calls = _local_calls()
+                now = monotonic()
+                delay = max(
+                    calls.get(key, -inf) - now for key in keys)
+                if delay > 0 and not _wait(keys, delay, timeout):
+                    return marker
+
+            if keys and script:
+                if len(keys) == len(key_fns):
+                    tail = args_tail
+                else:
+                    tiers = buckets.values()
+                    tail = ([minimums[tier] for tier in tiers] +
+                            [expires_ms[tier] for tier in tiers])
+                started = monotonic()
+                delay = _reserve(keys, keys, tail)
+                if delay is None:
+                    return marker
+                started += delay
+
+            elif keys and cache_add:
+                deadline = monotonic() + timeout
+                done = False
+
+                while not done:
+                    started, now = monotonic(), time()
+                    claimed = []
+                    for key, tier in buckets.items():
+                        slot = _claim(_slots(key), now, windows[tier])
+                        if slot is None:
                             break
-                        cache.set(key, now, expire)
-                if delay:
-                    if not retry:
-                        return marker
-                    log_info(_limits, 'retry in', delay)
-                    sleep(delay)
-                    done = False
-
-        return func(*args, **kwargs)
+                        claimed.append(slot)
+                    else:
+                        done = True
+                    if not done:
+                        # Give back the slots already claimed and wait
+                        # for the bucket that's full
+                        for slot in claimed:
+                            cache_delete(slot)
+                        delay = _claim_delay(
+                            _slots(key), now, windows[tier])
+                        remaining = _remaining(keys, deadline)
+                        if not _wait(keys, delay, remaining):
+                            return marker
+
+            elif keys:
+                # Always acquire in the same order to avoid deadlocks
+                lock_names = sorted(_lock_name(key) for key in keys)
+                deadline = monotonic() + timeout
+                done = False
+
+                while not done:
+                    started = monotonic()
+                    with ExitStack() as locks:
+                        for lock_name in lock_names:
+                            locks.enter_context(cache_lock(lock_name))
+                        now = time()
+                        dues = cache_get_many(keys)
+                        delay = max(
+                            dues.get(key, 0) - tolerances[tier] - now
+                            for key, tier in buckets.items())
+                        done = delay <= 0
+                        if done:
+                            nextdues = {}
+                            for key, tier in buckets.items():
+                                due = max(dues.get(key, 0), now)
+                                nextdues[key] = due + minimums[tier]
+                            cache_set_many(nextdues, expire_many)
+                    if not done:
+                        remaining = _remaining(keys, deadline)
+                        if not _wait(keys, delay, remaining):
+                            return marker
+
+            if keys and local_fastpath:
+                for key, tier in buckets.items():
+                    calls[key] = started + minimums[tier]
+
+            return func(*args, **kwargs)
+
+        return wrapper
 
     return multi_limit if multi else single_limit